@@ -1,130 +1,321 @@
 import requests
-import json
+import orjson
 import logging
+import logging.handlers
+import queue
 import time
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+from psycopg2.extras import Json
 import os
-import datetime
+import atexit
+import weakref
+import threading
+import functools
+import uuid
+import io
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# load environment variables
-load_dotenv()
-
-# set up logging
-logging.basicConfig(filename='bitbucket_tests.log', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Configuration for the script
-oauth_consumer_key = os.getenv('test_oauth_consumer_key')
-oauth_consumer_secret = os.getenv('test_oauth_consumer_secret')
-db_host = os.getenv('test_db_host')
-db_port = os.getenv('test_db_port')
-db_name = os.getenv('test_db_name')
-db_user = os.getenv('test_db_user')
-db_password = os.getenv('test_db_password')
+# Configuration for the script; credentials are read from the environment in main()
 workspace = 'alokit-innovations-test'
 repo_name = 'on-prem-bitbucket-test-repo'
 webhook_url = 'https://968d-171-76-83-56.ngrok-free.app/api/bitbucket/callbacks/webhook'
+oauth_token_url = 'https://bitbucket.org/site/oauth2/access_token'
+repositories_api_url = 'https://api.bitbucket.org/2.0/repositories'
+token_cache_path = os.path.expanduser('~/.cache/bitbucket_oauth.json')
+
+# Upper bound on repos tested at once; also sizes the DB pool so each test can check out a connection
+max_concurrent_tests = 8
 
-def create_db_connection(db_host, db_name, db_user, db_password):
+class RateLimitRetry(Retry):
     """
-    Establish and return a connection to the database. 
+    Retry that also retries POSTs on 429, since a rate-limited request was never processed.
     """
-    try:
-        connection = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password
-        )
-        print("Successfully connected to the database.")
-        return connection
-    except psycopg2.DatabaseError as e:
-        logger.error(f"Failed to connect to the database: {e}")
-        return None
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429:
+            return bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+# Shared HTTP session so every call reuses the same keep-alive connections.
+# Each concurrent test has at most one Bitbucket request in flight, so one HTTP/1.1 keep-alive
+# connection per test worker is kept per host; HTTP/2 would only fold those few handshakes into one.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=max_concurrent_tests,
+    max_retries=RateLimitRetry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+))
+
+# Shared DB connection pool so queries don't pay a fresh connect/auth handshake; created by init_db_pool()
+POOL = None
+
+# Server-side prepared statements, created once per pooled connection
+PREPARED_STATEMENTS = {
+    "upsert_repo": """
+        INSERT INTO repos (repo_name, repo_owner, repo_provider, auth_info, metadata, git_url)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (repo_name, repo_owner, repo_provider) DO UPDATE SET
+        auth_info = EXCLUDED.auth_info,
+        metadata = EXCLUDED.metadata,
+        git_url = EXCLUDED.git_url
+    """,
+    "check_hunk": """
+        SELECT hunk_info FROM hunks
+        WHERE review_id=$1 and repo_name=$2 and repo_owner=$3 and repo_provider=$4
+    """,
+}
+_prepared_connections = weakref.WeakSet()
+
+def setup_logging():
+    """
+    Queue log records and write them to the log file from a background listener.
+    """
+    log_queue = queue.Queue(-1)
+    log_file_handler = logging.FileHandler('bitbucket_tests.log')
+    log_file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    log_listener = logging.handlers.QueueListener(log_queue, log_file_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+    logging.getLogger().setLevel(logging.INFO)
+
+def init_db_pool():
+    global POOL
+    # Build the DSN once (with proper quoting); every pooled connection reuses it
+    dsn = psycopg2.extensions.make_dsn(
+        host=os.getenv('test_db_host'),
+        port=os.getenv('test_db_port'),
+        dbname=os.getenv('test_db_name'),
+        user=os.getenv('test_db_user'),
+        password=os.getenv('test_db_password')
+    )
+    POOL = psycopg2.pool.ThreadedConnectionPool(minconn=1, maxconn=max_concurrent_tests, dsn=dsn)
+    atexit.register(POOL.closeall)
+
+def get_db_connection():
+    """
+    Check a connection out of the pool, preparing the shared statements on first use.
+    """
+    connection = POOL.getconn()
+    if connection not in _prepared_connections:
+        try:
+            with connection.cursor() as cur:
+                for name, statement in PREPARED_STATEMENTS.items():
+                    cur.execute(f"PREPARE {name} AS {statement}")
+            connection.commit()
+        except Exception:
+            # Prepared statements survive a rollback, so a half-prepared connection can't be reused
+            POOL.putconn(connection, close=True)
+            raise
+        _prepared_connections.add(connection)
+    return connection
+
+def json_column(obj):
+    """
+    Wrap a dict for a JSON column, serialized with orjson.
+    """
+    return Json(obj, dumps=lambda value: orjson.dumps(value).decode())
+
+@functools.lru_cache(maxsize=None)
+def repo_endpoints(workspace, repo_name):
+    """
+    Build the Bitbucket API URLs for a repository once and reuse them on every call.
+    """
+    repo_url = f"{repositories_api_url}/{workspace}/{repo_name}"
+    return {
+        "repo": repo_url,
+        "src": f"{repo_url}/src",
+        "branches": f"{repo_url}/refs/branches",
+        "pullrequests": f"{repo_url}/pullrequests",
+    }
 
 def get_oauth_token(client_id, client_secret):
     try:
-        url = "https://bitbucket.org/site/oauth2/access_token"
-        response = requests.post(url, auth=(client_id, client_secret), data={'grant_type': 'client_credentials'})
+        response = SESSION.post(oauth_token_url, auth=(client_id, client_secret), data={'grant_type': 'client_credentials'})
         response.raise_for_status()
-        return response.json()
+        return orjson.loads(response.content)
     except requests.RequestException as e:
         logger.error(f'Error getting OAuth token: {e}')
         raise
 
-def create_repo(workspace, repo_name, token):
+def refresh_oauth_token(client_id, client_secret, refresh_token):
     try:
-        url = f"https://api.bitbucket.org/2.0/repositories/{workspace}/{repo_name}"
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.post(url, headers=headers, json={"scm": "git"})
+        data = {'grant_type': 'refresh_token', 'refresh_token': refresh_token}
+        response = SESSION.post(oauth_token_url, auth=(client_id, client_secret), data=data)
         response.raise_for_status()
-        return response.json()
+        return orjson.loads(response.content)
+    except requests.RequestException as e:
+        logger.error(f'Error refreshing OAuth token: {e}')
+        raise
+
+def load_cached_token(client_id):
+    try:
+        with open(token_cache_path, 'rb') as f:
+            token = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    # Never hand one consumer's tokens to another
+    if token.get("client_id") != client_id:
+        return None
+    return token
+
+def save_cached_token(token):
+    temp_path = None
+    try:
+        os.makedirs(os.path.dirname(token_cache_path), exist_ok=True)
+        # mkstemp creates the file owner-only; replacing the old file means its permissions never apply
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(token_cache_path))
+        with open(fd, 'wb') as f:
+            f.write(orjson.dumps(token))
+        os.replace(temp_path, token_cache_path)
+    except OSError as e:
+        logger.error(f'Error caching OAuth token: {e}')
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def clear_cached_token():
+    try:
+        os.remove(token_cache_path)
+    except FileNotFoundError:
+        pass
+
+def get_access_token(client_id, client_secret):
+    """
+    Return a cached token while it has more than a minute left, otherwise refresh or fetch a new one.
+    """
+    now = int(time.time())
+    token = load_cached_token(client_id)
+    if token and token.get("expires_at_epoch", 0) > now + 60:
+        return token
+
+    auth_info = None
+    if token and token.get("refresh_token"):
+        try:
+            auth_info = refresh_oauth_token(client_id, client_secret, token["refresh_token"])
+        except requests.RequestException:
+            auth_info = None
+    if auth_info is None:
+        auth_info = get_oauth_token(client_id, client_secret)
+
+    expires_at_epoch = now + auth_info["expires_in"]
+    expires_at_formatted = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(expires_at_epoch)) ## Change the `expires_in` field to `expires_at` format
+    token = { "client_id": client_id,
+        "access_token": auth_info["access_token"],
+        "expires_at": expires_at_formatted,
+        "expires_at_epoch": expires_at_epoch,
+        "refresh_token": auth_info["refresh_token"]}
+    save_cached_token(token)
+    return token
+
+def authenticate(client_id, client_secret, repo_name):
+    """
+    Put a Bearer token on the session and return it with `repo_name`'s repo info.
+
+    Fetching the repo is the run's first real Bitbucket call; if it is rejected with 401
+    the cached token is dropped and the call retried once with a fresh token.
+    """
+    token = get_access_token(client_id, client_secret)
+    SESSION.headers["Authorization"] = f"Bearer {token['access_token']}"
+    try:
+        return token, ensure_repo(workspace, repo_name)
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 401:
+            raise
+    logger.info('Cached OAuth token was rejected, fetching a new one')
+    clear_cached_token()
+    token = get_access_token(client_id, client_secret)
+    SESSION.headers["Authorization"] = f"Bearer {token['access_token']}"
+    return token, ensure_repo(workspace, repo_name)
+
+def create_repo(workspace, repo_name):
+    try:
+        url = repo_endpoints(workspace, repo_name)["repo"]
+        response = SESSION.post(url, json={"scm": "git"})
+        response.raise_for_status()
+        return orjson.loads(response.content)
     except requests.RequestException as e:
         logger.error(f'Error creating repository: {e}')
         raise
 
-def create_branch(workspace, repo_name, token, source_branch, destination_branch):
+def get_repo(workspace, repo_name):
     try:
-        url = f"https://api.bitbucket.org/2.0/repositories/{workspace}/{repo_name}/refs/branches"
-        headers = {"Authorization": f"Bearer {token}"}
-        data = {"name": source_branch, "target": {"hash": destination_branch}}
-        response = requests.post(url, headers=headers, json=data)
+        url = repo_endpoints(workspace, repo_name)["repo"]
+        response = SESSION.get(url)
+        if response.status_code == 404:
+            return None
         response.raise_for_status()
+        return orjson.loads(response.content)
     except requests.RequestException as e:
-        logger.error(f'Error creating branch: {e}')
+        logger.error(f'Error fetching repository: {e}')
         raise
 
-def add_and_commit_change(workspace, repo_name, token, branch, filename, content):
+def ensure_repo(workspace, repo_name):
+    """
+    Return the long-lived scratch repo, creating it only if it doesn't exist yet.
+    """
+    return get_repo(workspace, repo_name) or create_repo(workspace, repo_name)
+
+def add_and_commit_change(workspace, repo_name, branch, filename, content, content_type=None):
+    """
+    Commit `content` (str, bytes or a binary file object) as `filename` on `branch`.
+    Text is sent as text/plain; other content is only labelled if `content_type` is given.
+    """
     try:
-        url = f"https://api.bitbucket.org/2.0/repositories/{workspace}/{repo_name}/src"
-        headers = {"Authorization": f"Bearer {token}"}
+        url = repo_endpoints(workspace, repo_name)["src"]
         data = {"message": "Add/Update file", "branch": branch}
-        files = {filename: (filename, content)}
-        response = requests.post(url, headers=headers, data=data, files=files)
+        if isinstance(content, str):
+            content = content.encode()
+            content_type = content_type or 'text/plain'
+        if isinstance(content, bytes):
+            content = io.BytesIO(content)
+        files = {filename: (filename, content, content_type)}
+        # Bitbucket answers 201 with an empty body, so there is nothing to decode
+        response = SESSION.post(url, data=data, files=files)
         response.raise_for_status()
-        return response.json()
     except requests.RequestException as e:
         logger.error(f'Error adding and committing change: {e}')
         raise
 
-def raise_pr(workspace, repo_name, token):
+def raise_pr(workspace, repo_name, source_branch, branch_created=None):
+    """
+    Commit a dummy change to `source_branch` and open a PR from it; `branch_created` is set once the branch exists.
+    """
     try:
-        source_branch = "feature/dummy"
         destination_branch = "main"
-        create_branch(workspace, repo_name, token, source_branch, destination_branch)
         filename = "dummy_file.txt"
         content = 'print("This is a modified dummy file")'
-        add_and_commit_change(workspace, repo_name, token, source_branch, filename, content)
-        url = f"https://api.bitbucket.org/2.0/repositories/{workspace}/{repo_name}/pullrequests"
-        headers = {"Authorization": f"Bearer {token}"}
+        # Committing to a branch that doesn't exist yet creates it off the main branch's head
+        add_and_commit_change(workspace, repo_name, source_branch, filename, content)
+        if branch_created is not None:
+            branch_created.set()
+        url = repo_endpoints(workspace, repo_name)["pullrequests"]
         data = {
             "title": "Dummy PR",
             "source": {"branch": {"name": source_branch}},
             "destination": {"branch": {"name": destination_branch}},
             "close_source_branch": True,
-            "reason": "Merging modified dummy feature",
         }
-        response = requests.post(url, headers=headers, json=data)
+        response = SESSION.post(url, json=data)
         response.raise_for_status()
-        return response.json()
+        return orjson.loads(response.content)
     except requests.RequestException as e:
         logger.error(f'Error raising PR: {e}')
         raise
 
-def store_repo_data(connection, name, workspace, auth_info, provider, metadata, git_url):
+def store_repo_data(name, workspace, auth_info, provider, metadata, git_url):
+    connection = get_db_connection()
+    cur = None
     try:
         cur = connection.cursor()
-        query = """
-            INSERT INTO repos (repo_name, repo_owner, repo_provider, auth_info, metadata, git_url) 
-            VALUES (%s, %s, %s, %s, %s, %s)
-            ON CONFLICT (repo_name, repo_owner, repo_provider) DO UPDATE SET 
-            auth_info = EXCLUDED.auth_info, 
-            metadata = EXCLUDED.metadata,
-            git_url = EXCLUDED.git_url
-        """
         params = (name, workspace, provider, auth_info, metadata, git_url)
-        cur.execute(query, params)
+        cur.execute("EXECUTE upsert_repo (%s, %s, %s, %s, %s, %s)", params)
         connection.commit()
     except Exception as e:
         logger.error(f'Error storing repo data: {e}')
@@ -132,6 +323,7 @@ def store_repo_data(connection, name, workspace, auth_info, provider, metadata,
     finally:
         if cur:
             cur.close()
+        POOL.putconn(connection)
 
 def simulate_webhook_event(webhook_url, pr_info, repo_data):
     try:
@@ -139,71 +331,125 @@ def simulate_webhook_event(webhook_url, pr_info, repo_data):
             "pullrequest": pr_info,
             "repository": repo_data
         }
-        response = requests.post(webhook_url, json=payload)
+        headers = {"Content-Type": "application/json", "Authorization": None}  # don't leak the Bitbucket token
+        # The reply is tiny; reading it lets the connection go back to the pool for the next test's webhook
+        response = SESSION.post(webhook_url, data=orjson.dumps(payload), headers=headers)
         response.raise_for_status()
     except requests.RequestException as e:
         logger.error(f'Error simulating webhook event: {e}')
         raise
 
-def check_db_for_hunk_info(connection, pr_number, repo_name, repo_owner, provider):
+def check_db_for_hunk_info(pr_number, repo_name, repo_owner, provider, timeout=180, stop_event=None):
+    """
+    Poll the hunks table until the PR's hunk info shows up, `timeout` seconds pass or `stop_event` is set.
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+    connection = get_db_connection()
+    cur = None
     try:
-        time.sleep(180)
+        start = time.monotonic()
+        attempt = 0
         cur = connection.cursor()
-        cur.execute("SELECT hunk_info FROM hunks WHERE review_id=%s and repo_name=%s and repo_owner=%s and repo_provider=%s", (pr_number, repo_name, repo_owner, provider))
-        row = cur.fetchone()
-        return bool(row)
+        while True:
+            cur.execute("EXECUTE check_hunk (%s, %s, %s, %s)", (pr_number, repo_name, repo_owner, provider))
+            if cur.fetchone():
+                return True
+            # End the read transaction so the next poll gets a fresh snapshot and the session isn't left idle in transaction
+            connection.rollback()
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                return False
+            if stop_event.wait(min(2 ** attempt, 10, remaining)):
+                return False
+            attempt += 1
     except Exception as e:
         logger.error(f'Error checking DB for hunk info: {e}')
         raise
     finally:
         if cur:
             cur.close()
+        POOL.putconn(connection)
 
-def delete_repo(workspace, repo_name, token):
+def delete_branch(workspace, repo_name, branch):
     try:
-        url = f"https://api.bitbucket.org/2.0/repositories/{workspace}/{repo_name}"
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.delete(url, headers=headers)
+        url = f'{repo_endpoints(workspace, repo_name)["branches"]}/{branch}'
+        response = SESSION.delete(url)
         response.raise_for_status()
     except requests.RequestException as e:
-        logger.error(f'Error deleting repository: {e}')
+        logger.error(f'Error deleting branch: {e}')
         raise
 
+def run_one_test(repo_name, auth_info, repo_info=None):
+    """
+    Raise a PR on the scratch repo and report whether its hunk info reached the database.
+    """
+    if repo_info is None:
+        repo_info = ensure_repo(workspace, repo_name)
+
+    metadata = json_column({ "provider_repo_id": repo_info["uuid"]})
+    git_url = [repo_info["links"]["clone"][1]["href"]]
+
+    source_branch = f"feature/dummy-{uuid.uuid4().hex[:8]}"
+    branch_created = threading.Event()
+    try:
+        # Storing the repo row and raising the PR don't depend on each other, so overlap them
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            store_future = executor.submit(store_repo_data, repo_name, workspace, json_column(auth_info), 'bitbucket', metadata, git_url)
+            pr_future = executor.submit(raise_pr, workspace, repo_name, source_branch, branch_created)
+            store_future.result()
+            pr_info = pr_future.result()
+
+        # Start polling for the hunk row while the webhook is still in flight
+        stop_polling = threading.Event()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            webhook_future = executor.submit(simulate_webhook_event, webhook_url, pr_info, repo_info)
+            hunk_future = executor.submit(check_db_for_hunk_info, pr_info['id'], repo_name, workspace, 'bitbucket', stop_event=stop_polling)
+            try:
+                webhook_future.result()
+            except Exception:
+                stop_polling.set()
+                raise
+            return hunk_future.result()
+    finally:
+        # The repo is kept for the next run; only this run's branch is cleaned up.
+        # A failed cleanup must not mask the test's own error.
+        if branch_created.is_set():
+            try:
+                delete_branch(workspace, repo_name, source_branch)
+            except requests.RequestException:
+                logger.error(f'Leaving branch {source_branch} behind in {repo_name}')
+
 def main():
+    # load environment variables
+    load_dotenv()
+    setup_logging()
     try:
-        connection = create_db_connection(db_host, db_name, db_user, db_password)
-        if connection is None:
-            logger.error("Exiting due to database connection failure.")
-            return
-        
-        auth_info = get_oauth_token(oauth_consumer_key, oauth_consumer_secret)
-        expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=auth_info["expires_in"])
-        expires_at_formatted = expires_at.strftime("%Y-%m-%dT%H:%M:%SZ") ## Change the `expires_in` field to `expires_at` format
-        
-        auth_info = { "access_token": auth_info["access_token"],
-            "expires_at": expires_at_formatted,
-            "refresh_token": auth_info["refresh_token"],
+        init_db_pool()
+        repo_names = [name.strip() for name in os.getenv('test_repo_names', '').split(',') if name.strip()]
+        if not repo_names:
+            # Unset, empty or only separators: fall back to the default scratch repo
+            repo_names = [repo_name]
+        token, first_repo_info = authenticate(os.getenv('test_oauth_consumer_key'), os.getenv('test_oauth_consumer_secret'), repo_names[0])
+        known_repo_info = {repo_names[0]: first_repo_info}
+        auth_info = { "access_token": token["access_token"],
+            "expires_at": token["expires_at"],
+            "refresh_token": token["refresh_token"],
             "worspace_slug": ['alokit_innovations_test']}
-        
-        repo_info = create_repo(workspace, repo_name, auth_info["access_token"])
-        
-        metadata = json.dumps({ "provider_repo_id": repo_info["uuid"]}),
-        git_url = [repo_info["links"]["clone"][1]["href"]]
-        
-        store_repo_data(connection, repo_name, workspace, json.dumps(auth_info), metadata, git_url)
-        pr_info = raise_pr(workspace, repo_name, auth_info["access_token"])
-        simulate_webhook_event(webhook_url, pr_info, repo_info)
-
-        if check_db_for_hunk_info(connection, pr_info['id'], repo_name, workspace, 'bitbucket'):
-            print("Hunk info is stored in the database.")
-
-        delete_repo(workspace, repo_name, auth_info["access_token"])
+
+        # Each repo is tested independently; the pool size caps how many hit Bitbucket at once
+        with ThreadPoolExecutor(max_workers=max_concurrent_tests) as executor:
+            futures = {executor.submit(run_one_test, name, auth_info, known_repo_info.get(name)): name for name in repo_names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    if future.result():
+                        print(f"Hunk info is stored in the database for {name}.")
+                except Exception as e:
+                    logger.error(f"Test for {name} failed: {e}")
     except Exception as e:
         logger.error(f"An error occurred: {e}")
-        if connection:
-            connection.close()
-            logger.info("Database connection closed due to an error.")
         return
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()